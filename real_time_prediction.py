@@ -1,14 +1,13 @@
 import time
-import csv
 import threading
 import os
+import queue
+import atexit
 import joblib
 import numpy as np
-from collections import defaultdict, deque
+from numba import njit
 from pythonosc.dispatcher import Dispatcher
 from pythonosc import osc_server
-from scipy.signal import find_peaks
-from sklearn.preprocessing import MinMaxScaler
 
 import socket  # For UDP communication with Unity
 
@@ -16,27 +15,43 @@ import socket  # For UDP communication with Unity
 UNITY_IP = "127.0.0.1"  # Localhost - change if Unity runs on another machine
 UNITY_PORT = 8052       # Must match Unity's listening port
 unity_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+unity_socket.setblocking(False)  # A full send buffer raises instead of stalling the sender thread
+alert_queue = queue.SimpleQueue()  # Alert messages waiting to be sent to Unity
 
 # Cognitive load tracking
-last_predictions = deque(maxlen=10)  # Stores last 10 predictions
-ALERT_THRESHOLD = 9                 # Number of consecutive matches needed
+ALERT_THRESHOLD = 10                # Number of consecutive matching predictions needed
+last_prediction = None              # Most recent prediction
+prediction_streak = 0               # How many times in a row it has been predicted
+
+# Aggregation cadence
+AGGREGATE_INTERVAL = 2.0            # Longest wait between aggregation ticks (seconds)
+AGGREGATE_MIN_SAMPLES = 50          # New PPG:IR samples that wake the aggregator early
+data_ready = threading.Event()      # Set by the OSC thread once enough PPG:IR has arrived
+
+# Batched inference
+PREDICTION_BATCH_SIZE = 1           # Rows per prediction call (raise to amortize)
+PREDICTION_MAX_DELAY = 10.0         # A partial batch is predicted once its oldest row is this old (seconds)
+pending_features = np.empty((PREDICTION_BATCH_SIZE, 3), dtype=np.float32)  # Rows awaiting a batched prediction
+pending_rows = []                   # [timestamp, EDA, Temp, BVA] for each pending row
 
 # Configuration
 MODEL_DIR = "models"
 SCALER_DIR = "scalers"
 ENCODER_DIR = "encoders"
 
-# Buffer for storing incoming data
-data_buffer = defaultdict(lambda: deque(maxlen=500))
-
-# Lock for thread-safe access
-lock = threading.Lock()
-
 # Output CSV files
 csv_file = "emotibit_data.csv"
 cogload_file = "cognitive_load_data.csv"
 prediction_file = "cognitive_load_predictions.csv"
 
+# Batched CSV output
+CSV_BATCH_ROWS = 5              # Ticks accumulated before rows are handed to the writer thread
+CSV_BUFFER_SIZE = 64 * 1024     # Per-file write buffer
+output_files = {}               # Open handles, kept for the lifetime of the process
+csv_batches = {csv_file: [], cogload_file: [], prediction_file: []}  # Rows not yet queued
+csv_queue = queue.Queue()       # (path, rows) batches for the writer thread; None stops it
+stopping = threading.Event()    # Set at exit so the aggregator stops before the final drain
+
 # Field names
 fieldnames = [
     "timestamp", "ACC:X", "ACC:Y", "ACC:Z",
@@ -44,6 +59,30 @@ fieldnames = [
     "GYRO:X", "GYRO:Y", "GYRO:Z", "MAG:X", "MAG:Y", "MAG:Z"
 ]
 
+# Header and precompiled row format per output file (fixed schema, numeric values)
+csv_headers = {
+    csv_file: fieldnames,
+    cogload_file: ["EDA", "Temp", "BVA"],
+    prediction_file: ["timestamp", "EDA", "Temp", "BVA", "CognitiveLoad"],
+}
+row_formats = {
+    path: ",".join(["{}"] * len(header)) + "\r\n"  # Same line ending as csv.writer
+    for path, header in csv_headers.items()
+}
+
+# Preallocated single-producer/single-consumer ring buffer per incoming signal
+# (BVA is derived, not received), one row each. Only the OSC thread advances a
+# head and only the aggregator advances a tail, so no lock is needed.
+BUFFER_SIZE = 500
+signal_names = [name for name in fieldnames[1:] if name != "BVA"]
+signal_rows = {name: i for i, name in enumerate(signal_names)}
+PPG_ROW = signal_rows["PPG:IR"]
+signal_aliases = {"TEMP2": "T1"}  # Alternate names some EmotiBit firmware sends
+address_rows = {}                 # OSC address -> buffer row (-1 = ignored), filled on first sight
+data_buffer = np.empty((len(signal_names), BUFFER_SIZE), dtype=np.float32)
+buffer_head = [0] * len(signal_names)                       # Samples written (OSC thread)
+buffer_tail = np.zeros(len(signal_names), dtype=np.int64)   # Samples consumed (aggregator)
+
 # Load ML components
 def load_ml_components():
     """Load the trained model, scalers, and label encoder"""
@@ -57,170 +96,318 @@ def load_ml_components():
         print(f"Error loading ML components: {e}")
         return None, None, None, None
 
+def flatten_forest(clf):
+    """Stack every tree of the forest into padded (n_trees, max_nodes) arrays"""
+    trees = [estimator.tree_ for estimator in clf.estimators_]
+    shape = (len(trees), max(tree.node_count for tree in trees))
+    children_left = np.full(shape, -1, dtype=np.int32)   # -1 marks a leaf (and padding)
+    children_right = np.full(shape, -1, dtype=np.int32)
+    feature = np.zeros(shape, dtype=np.int32)
+    threshold = np.zeros(shape, dtype=np.float64)        # sklearn compares float32 X to float64 thresholds
+    leaf_proba = np.zeros(shape + (len(clf.classes_),), dtype=np.float64)
+    for t, tree in enumerate(trees):
+        n = tree.node_count
+        children_left[t, :n] = tree.children_left
+        children_right[t, :n] = tree.children_right
+        feature[t, :n] = np.maximum(tree.feature, 0)     # Leaves store -2; never read
+        threshold[t, :n] = tree.threshold
+        value = tree.value[:, 0, :]
+        leaf_proba[t, :n] = value / value.sum(axis=1, keepdims=True)  # Same as tree.predict_proba
+    return children_left, children_right, feature, threshold, leaf_proba
+
 clf, std_scaler, bva_scaler, label_encoder = load_ml_components()
 
+# Fold the BVA MinMaxScaler (X * scale_ + min_) and the StandardScaler
+# ((X - mean_) / scale_) into one per-feature affine transform over
+# (EDA, Temp, BVA): features_scaled = features * feature_scale + feature_offset
+if None not in (std_scaler, bva_scaler):
+    feature_scale = 1.0 / std_scaler.scale_
+    feature_offset = -std_scaler.mean_ / std_scaler.scale_
+    feature_scale[2] = bva_scaler.scale_[0] / std_scaler.scale_[2]
+    feature_offset[2] = (bva_scaler.min_[0] - std_scaler.mean_[2]) / std_scaler.scale_[2]
+    feature_scale = feature_scale.astype(np.float32)
+    feature_offset = feature_offset.astype(np.float32)
+
+# Flatten the trained forest for forest_predict, and map its class indices
+# straight to label strings
+if None not in (clf, label_encoder):
+    forest = flatten_forest(clf)
+    class_labels = label_encoder.classes_[clf.classes_]
+
 # OSC Handler
 def generic_handler(address, *args):
-    signal = address.split("/")[-1]  # e.g., ACC:X
-    value = args[0]
-    if signal == "TEMP2":
-        signal = "T1"
-    with lock:
-        data_buffer[signal].append(value)
-
-def compute_bva(ppg_values):
-    """Compute Blood Volume Amplitude from PPG signal"""
-    if len(ppg_values) < 10:
-        return None
-
-    ppg_array = np.array(ppg_values)
-    peaks, _ = find_peaks(ppg_array)
-    troughs, _ = find_peaks(-ppg_array)
-
-    if len(peaks) == 0 or len(troughs) == 0:
-        return None
-
-    last_peak = ppg_array[peaks[-1]]
-    last_trough = ppg_array[troughs[-1]]
+    index = address_rows.get(address)
+    if index is None:
+        signal = address.rsplit("/", 1)[-1]  # e.g., ACC:X
+        signal = signal_aliases.get(signal, signal)
+        index = address_rows[address] = signal_rows.get(signal, -1)
+    if index < 0:
+        return
+    head = buffer_head[index]
+    data_buffer[index, head % BUFFER_SIZE] = args[0]
+    buffer_head[index] = head + 1  # Publish only after the slot is written
+    if index == PPG_ROW and not data_ready.is_set():
+        if head + 1 - buffer_tail[PPG_ROW] >= AGGREGATE_MIN_SAMPLES:
+            data_ready.set()  # Enough PPG:IR for a BVA window; wake the aggregator
+
+@njit(nogil=True, cache=True, fastmath=True)
+def aggregate_kernel(buffers, tails, heads, ppg_row, out_means, out_counts):
+    """Average samples received since the last tick and compute BVA from PPG:IR.
+
+    Consumes each ring from its tail up to the head snapshot, writing means and
+    sample counts into the output arrays. Returns the Blood Volume Amplitude
+    (last peak minus last trough), or -1.0 when it cannot be computed.
+    """
+    n_signals, size = buffers.shape
+    for s in range(n_signals):
+        start = max(tails[s], heads[s] - size)  # Oldest samples are overwritten
+        total = 0.0  # float64 accumulator, float32 result
+        for i in range(start, heads[s]):
+            total += buffers[s, i % size]
+        out_counts[s] = heads[s] - start
+        out_means[s] = total / out_counts[s] if out_counts[s] else 0.0
+        tails[s] = heads[s]
+
+    start = heads[ppg_row] - out_counts[ppg_row]
+    if out_counts[ppg_row] < 10:
+        return -1.0
+
+    # Walk PPG in arrival order; flat steps keep the previous direction so plateaus still count
+    prev = buffers[ppg_row, start % size]
+    direction = 0
+    last_peak = last_trough = 0.0
+    found_peak = found_trough = False
+    for i in range(start + 1, heads[ppg_row]):
+        value = buffers[ppg_row, i % size]
+        if value > prev:
+            if direction < 0:
+                last_trough = prev
+                found_trough = True
+            direction = 1
+        elif value < prev:
+            if direction > 0:
+                last_peak = prev
+                found_peak = True
+            direction = -1
+        prev = value
+
+    if not (found_peak and found_trough):
+        return -1.0
     return abs(last_peak - last_trough)
 
-def predict_cognitive_load(eda, temp, bva):
-    """Predict with proper feature name handling"""
+@njit(cache=True)
+def forest_predict(features, children_left, children_right, feature, threshold, leaf_proba):
+    """Class index per row, averaging leaf probabilities over the flattened forest like clf.predict"""
+    n_trees = children_left.shape[0]
+    predictions = np.empty(features.shape[0], dtype=np.int64)
+    votes = np.empty(leaf_proba.shape[2])
+    for r in range(features.shape[0]):
+        votes[:] = 0.0
+        for t in range(n_trees):
+            node = 0
+            while children_left[t, node] >= 0:
+                if features[r, feature[t, node]] <= threshold[t, node]:
+                    node = children_left[t, node]
+                else:
+                    node = children_right[t, node]
+            votes += leaf_proba[t, node]
+        predictions[r] = np.argmax(votes)
+    return predictions
+
+def predict_cognitive_load(features):
+    """Predict a batch of (EDA, Temp, BVA) rows with a single forest_predict call"""
     if None in (clf, std_scaler, bva_scaler, label_encoder):
-        return "MODEL_NOT_LOADED"
+        return ["MODEL_NOT_LOADED"] * len(features)
     
     try:
-        # Create DataFrame to preserve feature names
-        import pandas as pd
-        input_data = pd.DataFrame([[eda, temp, bva]], 
-                                columns=['EDA', 'Temp', 'BVA'])
-        
-        # 1. Scale BVA between 0 and 1
-        input_data['BVA'] = bva_scaler.transform(input_data[['BVA']])
+        # 1. Scale BVA between 0 and 1, then standardize all features (fused, float32 throughout)
+        features = np.asarray(features, dtype=np.float32)
+        features_scaled = features * feature_scale + feature_offset
         
-        # 2. Scale all features
-        features_scaled = std_scaler.transform(input_data)
-        
-        # 3. Predict and decode label
-        prediction_num = clf.predict(features_scaled)[0]
-        return label_encoder.inverse_transform([prediction_num])[0]
+        # 2. Predict and decode labels
+        return class_labels[forest_predict(features_scaled, *forest)]
         
     except Exception as e:
         print(f"Prediction failed: {e}")
-        return "PREDICTION_ERROR"
+        return ["PREDICTION_ERROR"] * len(features)
 
 def initialize_files():
-    """Initialize output files with headers"""
-    # Main data file
-    with open(csv_file, mode="w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+    """Open output files once for appending, writing headers to new or empty files"""
+    for path, header in csv_headers.items():
+        output_files[path] = open(path, mode="a", newline="", buffering=CSV_BUFFER_SIZE)
+        if os.path.getsize(path) == 0:
+            output_files[path].write(row_formats[path].format(*header))
+
+def queue_csv_batches():
+    """Hand accumulated rows to the CSV writer thread"""
+    for path, rows in csv_batches.items():
+        if rows:
+            csv_batches[path] = []
+            csv_queue.put((path, rows))
+
+def write_csv_batches():
+    """Write queued row batches off the aggregator thread"""
+    while True:
+        batch = csv_queue.get()
+        if batch is None:
+            break
+        path, rows = batch
+        row_format = row_formats[path]
+        output_files[path].write("".join(row_format.format(*row) for row in rows))
+        output_files[path].flush()
     
-    # Cognitive load data file
-    with open(cogload_file, mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["EDA", "Temp", "BVA"])
+    # Shutting down: make sure everything reaches the disk
+    for f in output_files.values():
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+def close_files():
+    """Stop the aggregator, write out any remaining rows, and close output files"""
+    stopping.set()
+    data_ready.set()  # Wake the aggregator if it is waiting
+    aggregator_thread.join()
     
-    # Prediction file
-    with open(prediction_file, mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["timestamp", "EDA", "Temp", "BVA", "CognitiveLoad"])
+    # The aggregator has exited, so pending rows and csv_batches are no longer touched elsewhere
+    flush_predictions(force=True)
+    queue_csv_batches()
+    csv_queue.put(None)
+    csv_writer_thread.join()
 
 def aggregate_and_save():
-    """Process data and save results every 2 seconds"""
-    initialize_files()
-    
-    # Initialize MinMaxScaler for BVA (0-1)
-    bva_scaler = MinMaxScaler(feature_range=(0, 1))
+    """Process data and save results whenever a window of data is ready (at least every 2 seconds)"""
+    # Per-tick outputs of aggregate_kernel
+    means = np.empty(len(signal_names), dtype=np.float32)
+    counts = np.empty(len(signal_names), dtype=np.int64)
     
     while True:
         
-        time.sleep(2)
+        # Wake as soon as enough PPG:IR has arrived, or after AGGREGATE_INTERVAL at the latest
+        woken = data_ready.wait(timeout=AGGREGATE_INTERVAL)
+        if stopping.is_set():
+            break
+        
+        # Snapshot heads in one pre-sized allocation; the OSC thread may keep writing
+        heads = np.fromiter(buffer_head, dtype=np.int64, count=len(buffer_head))
+        if woken and heads[PPG_ROW] - buffer_tail[PPG_ROW] < AGGREGATE_MIN_SAMPLES:
+            data_ready.clear()  # Stale wake-up from a sample that raced the last tick
+            continue
+        if np.array_equal(heads, buffer_tail):
+            flush_predictions()  # Nothing received since the last tick; just keep predictions timely
+            continue
+        
         timestamp = time.time()
         row = {"timestamp": timestamp}
         prediction_data = {}
 
-        with lock:
-            # Compute BVA first using PPG:IR
-            ppg_ir_values = list(data_buffer["PPG:IR"])
-            bva_value = compute_bva(ppg_ir_values)
+        # Average everything received since the last tick and compute BVA from PPG:IR
+        bva_value = aggregate_kernel(data_buffer, buffer_tail, heads, PPG_ROW, means, counts)
+        
+        # Only now that the PPG:IR tail has advanced is the wake condition false; clearing
+        # earlier lets samples arriving during the (nogil) kernel re-arm against the old tail
+        data_ready.clear()
+        if bva_value < 0:
+            bva_value = None
             
-            # Scale BVA between 0 and 1
-            if bva_value is not None:
-                bva_scaled = bva_scaler.fit_transform([[bva_value]])[0][0]
-            else:
-                bva_scaled = None
-                
-            row["BVA"] = bva_value  # Original value in main data file
-            prediction_data["BVA"] = bva_scaled  # Scaled value for cognitive load prediction
-
-            # Get other values
-            for key in fieldnames[1:]:
-                if key == "BVA":
-                    continue
-                if data_buffer[key]:
-                    row[key] = sum(data_buffer[key]) / len(data_buffer[key])
-                    data_buffer[key].clear()
-                else:
-                    row[key] = None
+        # Raw BVA everywhere; predict_cognitive_load applies the trained bva_scaler
+        row["BVA"] = bva_value
+        prediction_data["BVA"] = bva_value
 
-            # Clear PPG:IR after computing BVA
-            data_buffer["PPG:IR"].clear()
+        # Get other values
+        for key, index in signal_rows.items():
+            row[key] = float(means[index]) if counts[index] else None
 
-            # Prepare cognitive load data
-            prediction_data["EDA"] = row["EDA"]
-            prediction_data["Temp"] = row["T1"]  # Using T1 as temperature
+        # Prepare cognitive load data
+        prediction_data["EDA"] = row["EDA"]
+        prediction_data["Temp"] = row["T1"]  # Using T1 as temperature
 
-        # Save to main data file (with original BVA)
-        with open(csv_file, mode="a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writerow(row)
+        # Save to main data file
+        csv_batches[csv_file].append(["" if row[key] is None else row[key] for key in fieldnames])
 
         # Save cognitive load features if all data available
         if None not in (prediction_data["EDA"], prediction_data["Temp"], prediction_data["BVA"]):
-            # Save features with scaled BVA
-            with open(cogload_file, mode="a", newline="") as cf:
-                writer = csv.writer(cf)
-                writer.writerow([prediction_data["EDA"], prediction_data["Temp"], prediction_data["BVA"]])
+            # Save features
+            csv_batches[cogload_file].append([prediction_data["EDA"], prediction_data["Temp"], prediction_data["BVA"]])
             
-            # Make and save prediction
-            cognitive_load = predict_cognitive_load(
+            # Queue features for the next batched prediction
+            pending_features[len(pending_rows)] = (
                 prediction_data["EDA"],
                 prediction_data["Temp"],
-                prediction_data["BVA"]  # Already scaled
+                prediction_data["BVA"]
             )
-            
-            # Save prediction with scaled BVA
-            with open(prediction_file, mode="a", newline="") as pf:
-                writer = csv.writer(pf)
-                writer.writerow([timestamp, prediction_data["EDA"], 
-                               prediction_data["Temp"], prediction_data["BVA"], 
-                               cognitive_load])
-            
-            print(f"Predicted cognitive load: {cognitive_load}")
+            pending_rows.append([timestamp, prediction_data["EDA"],
+                                 prediction_data["Temp"], prediction_data["BVA"]])
+        
+        flush_predictions()
 
-            # Update prediction history
-            last_predictions.append(cognitive_load)
-            
-            # Check for 10 consecutive similar predictions
-            if len(last_predictions) >= 10:
-                unique_preds = set(last_predictions)
-                if len(unique_preds) == 1:  # All predictions are the same
-                    alert_message = f"ALERT|{cognitive_load.upper()}"
-                    send_unity_alert(alert_message)
-                    last_predictions.clear()  # Reset after alert
+        if len(csv_batches[csv_file]) >= CSV_BATCH_ROWS:
+            queue_csv_batches()
+
+def flush_predictions(force=False):
+    """Predict pending rows once the batch is full or its oldest row is stale"""
+    if not pending_rows:
+        return
+    if not (force or len(pending_rows) == PREDICTION_BATCH_SIZE
+            or time.time() - pending_rows[0][0] >= PREDICTION_MAX_DELAY):
+        return
+    
+    # Make predictions for the whole batch
+    predictions = predict_cognitive_load(pending_features[:len(pending_rows)])
+    
+    # Save predictions
+    csv_batches[prediction_file].extend(pending_row + [cognitive_load]
+                                        for pending_row, cognitive_load in zip(pending_rows, predictions))
+    
+    for cognitive_load in predictions:
+        print(f"Predicted cognitive load: {cognitive_load}")
+        update_alert_state(cognitive_load)
+    
+    pending_rows.clear()
+
+def update_alert_state(cognitive_load):
+    """Track the prediction streak and alert Unity on sustained cognitive load"""
+    global last_prediction, prediction_streak
+    
+    # Update the run of identical predictions
+    if cognitive_load == last_prediction:
+        prediction_streak += 1
+    else:
+        last_prediction = cognitive_load
+        prediction_streak = 1
+    
+    # Check for ALERT_THRESHOLD consecutive similar predictions
+    if prediction_streak >= ALERT_THRESHOLD:
+        alert_message = f"ALERT|{cognitive_load.upper()}"
+        send_unity_alert(alert_message)
+        last_prediction, prediction_streak = None, 0  # Reset after alert
 
 def send_unity_alert(message):
-    """Send alert message to Unity via UDP"""
-    try:
-        unity_socket.sendto(message.encode(), (UNITY_IP, UNITY_PORT))
-        print(f"Sent Unity alert: {message}")
-    except Exception as e:
-        print(f"Failed to send Unity alert: {e}")
+    """Queue an alert message for Unity without blocking the aggregator"""
+    alert_queue.put(message)
+
+def unity_alert_sender():
+    """Send queued alert messages to Unity via UDP"""
+    while True:
+        message = alert_queue.get()
+        try:
+            unity_socket.sendto(message.encode(), (UNITY_IP, UNITY_PORT))
+            print(f"Sent Unity alert: {message}")
+        except Exception as e:
+            print(f"Failed to send Unity alert: {e}")
+
+
+# Open output files and start the CSV writer thread
+initialize_files()
+csv_writer_thread = threading.Thread(target=write_csv_batches, daemon=True)
+csv_writer_thread.start()
+atexit.register(close_files)
 
+# Start Unity alert sender thread
+threading.Thread(target=unity_alert_sender, daemon=True).start()
 
 # Start aggregator thread
-threading.Thread(target=aggregate_and_save, daemon=True).start()
+aggregator_thread = threading.Thread(target=aggregate_and_save, daemon=True)
+aggregator_thread.start()
 
 # Set up OSC server
 dispatcher = Dispatcher()
@@ -228,7 +415,7 @@ dispatcher.set_default_handler(generic_handler)
 
 ip = "127.0.0.1"
 port = 12346  # Match with EmotiBit XML
-server = osc_server.ThreadingOSCUDPServer((ip, port), dispatcher)
+server = osc_server.BlockingOSCUDPServer((ip, port), dispatcher)  # Single OSC thread = single producer
 
 print(f"Listening on {ip}:{port}")
 print("Data collection and cognitive load prediction running...")